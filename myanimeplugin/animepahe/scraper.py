@@ -2,69 +2,108 @@ from __future__ import annotations
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
-    from typing import Iterable, Optional, Dict
+    from typing import Callable, Iterable, Optional, Dict, List
 
     from mov_cli import Config
     from mov_cli.http_client import HTTPClient
     from mov_cli.scraper import ScraperOptionsT
 
-import json
 import re
-from urllib.parse import quote_plus
+from itertools import islice
+from collections import OrderedDict
 
+from selectolax.lexbor import LexborHTMLParser
 from mov_cli.utils import EpisodeSelector
 from mov_cli import Scraper, Multi, Single, Metadata, MetadataType
 
+from ..utils import get, loads, cached, SEARCH_TTL, EPISODES_TTL, SOURCES_TTL
+
 __all__ = ("AnimePaheScraper",)
 
 class AnimePaheScraper(Scraper):
+    _PACKED_RE = re.compile(r"\}\('(.*)'\)*,*(\d+)*,*(\d+)*,*'((?:[^'\\]|\\.)*)'\.split\('\|'\)*,*(\d+)*,*(\{\})")
+    _WORD_RE = re.compile(r"\b(\w+)\b")
+    _M3U8_RE = re.compile(r"http.*.m3u8")
+    _EPISODE_LINKS = "div.clusterize-scroll a"
+    _ACTIVE_EMBED = "#resolutionMenu button.active"
+    _TREE_CACHE_SIZE = 16
+
     def __init__(self, config: Config, http_client: HTTPClient, options: Optional[ScraperOptionsT] = None) -> None:
         self.base_url = "https://animepahe.ru"
         self.api_url = f"{self.base_url}/api"
-        self.search_url = f"{self.api_url}?m=search&q="
-        self.release_url = f"{self.api_url}?m=release&id="
         self.play_url = f"{self.base_url}/play"
-        http_client.headers = {"Referer": self.base_url, "Cookie": config.data["ddg2"]}
+        self.headers = {"Referer": self.base_url, "Cookie": config.data["ddg2"]}
+        self._episodes_cache: Dict[str, List[str]] = {}
+        self._tree_cache: OrderedDict[str, LexborHTMLParser] = OrderedDict()
         super().__init__(config, http_client, options)
 
-    def _request(self, url: str, params: Optional[Dict] = None) -> Dict:
-        response = self.http_client.get(url, params=params)
-        return json.loads(response.text)
+    def _request(self, url: str, params: Optional[Dict] = None, persist: Optional[int] = None, store: Optional[Callable[[Dict], bool]] = None) -> Dict:
+        def fetch() -> Dict:
+            response = get(url, params=params, headers=self.headers)
+            return loads(response.content)
+        return cached(url, params, fetch, persist, store=store)
+
+    def _request_html(self, url: str, params: Optional[Dict] = None, persist: Optional[int] = None, store: Optional[Callable[[str], bool]] = None) -> str:
+        def fetch() -> str:
+            response = get(url, params=params, headers=self.headers)
+            return response.text
+        return cached(url, params, fetch, persist, namespace="html", store=store)
+
+    def _get_tree(self, url: str, selector: str) -> LexborHTMLParser:
+        '''
+        parsed page for url, kept in a small LRU so revisiting an episode skips the fetch and the parse.
+        pages without a match for selector (e.g. a DDoS-Guard interstitial) are returned but never cached
+        '''
+        tree = self._tree_cache.get(url)
+        if tree is not None:
+            self._tree_cache.move_to_end(url)
+            return tree
+
+        parsed = {}
+        def usable(html: str) -> bool:
+            parsed[html] = LexborHTMLParser(html)
+            return parsed[html].css_first(selector) is not None
+
+        html = self._request_html(url, persist=EPISODES_TTL, store=usable)
+        tree = parsed.get(html) or LexborHTMLParser(html)
+        if tree.css_first(selector) is None: return tree
+        self._tree_cache[url] = tree
+        if len(self._tree_cache) > self._TREE_CACHE_SIZE: self._tree_cache.popitem(last=False)
+        return tree
 
-    def _request_html(self, url: str, params: Optional[Dict] = None) -> str:
-        response = self.http_client.get(url, params=params)
-        return response.text
+    def _get_episode_urls(self, anime_id: str) -> List[str]:
+        urls = self._episodes_cache.get(anime_id)
+        if urls is None:
+            response = self._request(self.api_url, params={"m": "release", "id": anime_id, "sort": "episode_asc", "page": 1}, persist=EPISODES_TTL, store=lambda response: bool(response.get("data")))
+            if not response.get("data"): return []
+            tree = self._get_tree(f"{self.play_url}/{anime_id}/{response['data'][0]['session']}", self._EPISODE_LINKS)
+            items = tree.css(self._EPISODE_LINKS)
+            urls = [item.attributes.get("href") for item in items]
+            if urls: self._episodes_cache[anime_id] = urls
+        return urls
 
     def search(self, query: str, limit: int = None) -> Iterable[Metadata]:
-        response = self._request(f"{self.search_url}{quote_plus(query)}")
+        response = self._request(self.api_url, params={"m": "search", "q": query}, persist=SEARCH_TTL)
         animes = response.get("data", [])
-        if limit is not None: animes = animes[:limit]
-        for anime in animes:
+        multi, single = MetadataType.MULTI, MetadataType.SINGLE
+        for anime in (islice(animes, limit) if limit is not None else animes):
             yield Metadata(
                 id=anime["session"],
                 title=anime["title"],
-                type=MetadataType.MULTI if anime["episodes"] > 1 else MetadataType.SINGLE,
+                type=multi if anime["episodes"] > 1 else single,
             )
 
     def scrape_episodes(self, metadata: Metadata) -> Dict[int | None, int]:
-        response = self._request(f"{self.release_url}{metadata.id}&sort=episode_asc&page=1")
-        if not response.get("data"): return {}
-        get_all_eps = self._request_html(f"{self.play_url}/{metadata.id}/{response['data'][0]['session']}")
-        soup = self.soup(get_all_eps)
-        items = soup.find("div", {"class": "clusterize-scroll"}).findAll("a")
-        urls = [items[i].get("href") for i in range(len(items))]
-        episode_map = {}
-        episode_map[1] = len(urls) # [season] = episodes
-        if not episode_map: return {None: 1}
-        return episode_map
+        urls = self._get_episode_urls(metadata.id)
+        if not urls: return {}
+        return {1: len(urls)} # [season] = episodes
 
     def parse_m3u8_link(self, text) -> str:
         '''
         parse m3u8 link using javascript's packed function implementation
         '''
-        x = r"\}\('(.*)'\)*,*(\d+)*,*(\d+)*,*'((?:[^'\\]|\\.)*)'\.split\('\|'\)*,*(\d+)*,*(\{\})"
         try:
-            p, a, c, k, e, d = re.findall(x, text)[0]
+            p, a, c, k, e, d = self._PACKED_RE.findall(text)[0]
             p, a, c, k, e, d = p, int(a), int(c), k.split('|'), int(e), {}
         except Exception as e:
             raise Exception('m3u8 link extraction failed. Unable to extract packed args')
@@ -74,31 +113,28 @@ class AnimePaheScraper(Scraper):
             c = c % a
             return x + (chr(c + 29) if c > 35 else '0123456789abcdefghijklmnopqrstuvwxyz'[c])
 
-        for i in range(c): d[e(i)] = k[i] or e(i)
-        parsed_js_code = re.sub(r'\b(\w+)\b', lambda e: d.get(e.group(0)) or e.group(0), p)
-        regex_extract = lambda rgx, txt, grp: re.search(rgx, txt).group(grp) if re.search(rgx, txt) else False
-        parsed_link = regex_extract('http.*.m3u8', parsed_js_code, 0)
-        if not parsed_link: raise Exception('m3u8 link extraction failed. link not found')
-        return parsed_link
+        for i in range(c):
+            key = e(i) # recursive, so only encode each index once
+            d[key] = k[i] or key
+        lookup = d.get
+        parsed_js_code = self._WORD_RE.sub(lambda m: lookup(m.group(0)) or m.group(0), p)
+        match = self._M3U8_RE.search(parsed_js_code)
+        if not match: raise Exception('m3u8 link extraction failed. link not found')
+        return match.group(0)
 
     def scrape(self, metadata: Metadata, episode: EpisodeSelector) -> Multi | Single:
-        response = self._request(f"{self.release_url}{metadata.id}&sort=episode_asc&page=1")
-        if not response.get("data"): return {}
-        get_all_eps = self._request_html(f"{self.play_url}/{metadata.id}/{response['data'][0]['session']}")
-        soup = self.soup(get_all_eps)
-        items = soup.find("div", {"class": "clusterize-scroll"}).findAll("a")
-        urls = [items[i].get("href") for i in range(len(items))]
+        urls = self._get_episode_urls(metadata.id)
+        if not urls: return {}
         target_episode = None
         if metadata.type == MetadataType.MULTI:
             target_episode = urls[episode.episode-1] if episode and episode.episode else urls[0]
         elif urls:
             target_episode = urls[0]
-        episode_page_url = f"{self.base_url}{target_episode}"
-        episode_page_html = self._request_html(episode_page_url)
-        soup = self.soup(episode_page_html)
-        embed_sources = soup.find("div", {"id": "resolutionMenu"}).findAll("button", {"class": "active"}) # TODO: Add quality selection
-        embed_url = embed_sources[0].get("data-src")
-        embed_html = self._request_html(embed_url)
+        tree = self._get_tree(f"{self.base_url}{target_episode}", self._ACTIVE_EMBED)
+        embed_source = tree.css_first(self._ACTIVE_EMBED) # TODO: Add quality selection
+        if embed_source is None: raise Exception('embed link extraction failed. No embed sources found')
+        embed_url = embed_source.attributes.get("data-src")
+        embed_html = self._request_html(embed_url, persist=SOURCES_TTL, store=lambda html: self._PACKED_RE.search(html) is not None)
         video_url = self.parse_m3u8_link(embed_html)
 
         if metadata.type == MetadataType.MULTI:
@@ -2,81 +2,106 @@ from __future__ import annotations
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
-    from typing import Iterable, Optional, Dict
+    from typing import Callable, Iterable, Optional, Dict, List
+    from concurrent.futures import Future
 
     from mov_cli import Config
     from mov_cli.http_client import HTTPClient
     from mov_cli.scraper import ScraperOptionsT
 
-import json
-from urllib.parse import quote_plus
+from itertools import islice
 
 from mov_cli.utils import EpisodeSelector
 from mov_cli import Scraper, Multi, Single, Metadata, MetadataType
 
+from ..utils import get, loads, submit, cached, SEARCH_TTL, EPISODES_TTL, SOURCES_TTL
+
 __all__ = ("HiAnimeScraper",)
 
 class HiAnimeScraper(Scraper):
+    prefetch_episodes = 5 # warm the episode list of the top N search results in the background
+
     def __init__(self, config: Config, http_client: HTTPClient, options: Optional[ScraperOptionsT] = None) -> None:
         self.base_url = "https://aniwatch-api-7ehn.onrender.com/api/v2/hianime"
         self.search_url = f"{self.base_url}/search"
         self.anime_url = f"{self.base_url}/anime"
         self.episode_url = f"{self.base_url}/episode/sources"
+        self.headers = {}
+        self._episodes_cache: Dict[str, Dict[int, str]] = {}
         super().__init__(config, http_client, options)
 
-    def _request(self, url: str, params: Optional[Dict] = None) -> Dict:
-        response = self.http_client.get(url, params=params)
-        return json.loads(response.text)
+    def _request(self, url: str, params: Optional[Dict] = None, persist: Optional[int] = None, store: Optional[Callable[[Dict], bool]] = None) -> Dict:
+        def fetch() -> Dict:
+            response = get(url, params=params, headers=self.headers)
+            return loads(response.content)
+        return cached(url, params, fetch, persist, store=store)
+
+    def _get_sources(self, episode_id: str) -> Dict:
+        return self._request(self.episode_url, params={"animeEpisodeId": episode_id}, persist=SOURCES_TTL, store=lambda response: bool(response.get("data", {}).get("sources")))
+
+    def _get_episodes(self, anime_id: str) -> Dict[int, str]:
+        '''
+        episode number -> episodeId, the only fields scrape needs, so the full episode objects are never kept around
+        '''
+        episodes = self._episodes_cache.get(anime_id)
+        if episodes is None:
+            url = f"{self.anime_url}/{anime_id}/episodes"
+            def fetch() -> Dict[int, str]:
+                response = get(url, headers=self.headers)
+                return {ep["number"]: ep["episodeId"] for ep in loads(response.content)["data"]["episodes"]}
+            episodes = cached(url, None, fetch, EPISODES_TTL, namespace="hianime-episodes", store=bool)
+            if episodes: self._episodes_cache[anime_id] = episodes
+        return episodes
 
     def search(self, query: str, limit: int = None) -> Iterable[Metadata]:
-        response = self._request(f"{self.search_url}?q={quote_plus(query)}")
+        response = self._request(self.search_url, params={"q": query}, persist=SEARCH_TTL)
         animes = response["data"]["animes"]
-        if limit is not None: animes = animes[:limit]
-        for anime in animes:
+        multi, single = MetadataType.MULTI, MetadataType.SINGLE
+        for index, anime in enumerate(islice(animes, limit) if limit is not None else animes):
+            if index < self.prefetch_episodes: submit(self._get_episodes, anime["id"])
             yield Metadata(
                 id=anime["id"],
                 title=anime["name"],
-                type=MetadataType.MULTI if anime["episodes"]["sub"] > 1 else MetadataType.SINGLE,
+                type=multi if anime["episodes"]["sub"] > 1 else single,
             )
 
     def scrape_episodes(self, metadata: Metadata) -> Dict[int | None, int]:
-        anime_details = self._request(f"{self.anime_url}/{metadata.id}/episodes")
-        episodes = anime_details["data"]["episodes"]
-        episode_map = {}
-        episode_map[1] = len(episodes) # [season] = episodes
-        if not episode_map: return {None: 1}
-        return episode_map
+        episodes = self._get_episodes(metadata.id)
+        if not episodes: return {None: 1}
+        return {1: len(episodes)} # [season] = episodes
+
+    def prefetch_sources(self, metadata: Metadata, episode_nums: Iterable[int]) -> List[Future]:
+        '''
+        resolve the sources of several episodes concurrently so later scrape calls are served from the cache
+        '''
+        episodes = self._get_episodes(metadata.id)
+        return [submit(self._get_sources, episodes[num]) for num in episode_nums if num in episodes]
 
     def scrape(self, metadata: Metadata, episode: EpisodeSelector) -> Multi | Single:
-        anime_details = self._request(f"{self.anime_url}/{metadata.id}/episodes")
-        episodes = anime_details["data"]["episodes"]
+        episodes = self._get_episodes(metadata.id)
 
         # Find the requested episode
-        target_episode = None
+        episode_id = None
         if metadata.type == MetadataType.MULTI:
             episode_num = episode.episode if episode and episode.episode else 1
-            for ep in episodes:
-                if ep["number"] == episode_num:
-                    target_episode = ep
-                    break
+            episode_id = episodes.get(episode_num)
+            # Speculatively resolve the next episode alongside the current one
+            self.prefetch_sources(metadata, [episode_num + 1])
         else:
             # For a single, just grab the first episode
             if episodes:
-                target_episode = episodes[0]
+                episode_id = next(iter(episodes.values()))
 
-        sources_response = self._request(f"{self.episode_url}?animeEpisodeId={target_episode['episodeId']}")
+        if episode_id is None: raise Exception('sources extraction failed. Episode not found')
+        sources_response = self._get_sources(episode_id)
         video_url = sources_response["data"]["sources"][0]["url"]
 
-        subtitles = []
-        if "tracks" in sources_response["data"]:
-            for track in sources_response["data"]["tracks"]:
-                if track["kind"] == "captions":
-                    subtitles.append(track["file"])
+        subtitles = [track["file"] for track in sources_response["data"].get("tracks", ()) if track.get("kind") == "captions"]
 
         if metadata.type == MetadataType.MULTI:
             return Multi(
                 url=video_url,
-                title=f"{metadata.title} - Episode {target_episode['number']}",
+                title=f"{metadata.title} - Episode {episode_num}",
                 episode=episode,
                 subtitles=subtitles
             )
@@ -0,0 +1,215 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Any, Callable, Optional, Dict, Hashable, Tuple
+    from concurrent.futures import Future
+
+import os
+import time
+import sqlite3
+import random
+import threading
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from cachetools import TTLCache
+
+try:
+    from orjson import loads
+except ImportError:
+    from json import loads
+
+try:
+    import diskcache
+except ImportError:
+    diskcache = None
+
+__all__ = ("get_client", "get", "loads", "submit", "get_disk_cache", "cache_key", "cached", "SEARCH_TTL", "EPISODES_TTL", "SOURCES_TTL")
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:128.0) Gecko/20100101 Firefox/128.0"
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RATE_LIMIT_STATUSES = (429, 503) # the only statuses whose Retry-After / X-RateLimit-Reset we honour
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 1
+MAX_RETRY_WAIT = 30 # give up rather than block the CLI for longer than this
+
+# how long each kind of response may be reused from the on-disk cache across runs
+SEARCH_TTL = 60 * 60
+EPISODES_TTL = 30 * 60
+SOURCES_TTL = 5 * 60
+
+DISK_CACHE_FORMAT = 1 # bump whenever the shape of a persisted value changes
+DISK_CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "mov-cli-hianime")
+
+_client: Optional[httpx.Client] = None
+_client_lock = threading.Lock()
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+_background = threading.local()
+
+_CACHE: TTLCache = TTLCache(maxsize=256, ttl=300)
+_CACHE_LOCK = threading.Lock()
+_INFLIGHT: Dict[Hashable, threading.Event] = {}
+_MISSING = object()
+
+_disk_cache: Optional[diskcache.Cache] = None
+_disk_cache_lock = threading.Lock()
+_disk_cache_failed = False
+
+def get_client() -> httpx.Client:
+    '''
+    shared HTTP/2 client, created on first use so both scrapers multiplex over the same connections
+    '''
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = httpx.Client(
+                    transport=httpx.HTTPTransport(
+                        http2=True,
+                        limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+                        retries=MAX_RETRIES # connection failures only, statuses are handled in get()
+                    ),
+                    headers={"User-Agent": USER_AGENT},
+                    follow_redirects=True,
+                    timeout=30
+                )
+    return _client
+
+def _retry_after(response: httpx.Response) -> Optional[float]:
+    '''
+    seconds the server asked us to wait, from Retry-After or X-RateLimit-Reset
+    '''
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is not None:
+        try:
+            return max(0, float(retry_after))
+        except ValueError:
+            try:
+                return max(0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+
+    reset = response.headers.get("X-RateLimit-Reset")
+    if reset is None: return None
+    try:
+        reset = float(reset)
+    except ValueError:
+        return None
+    # some APIs send an epoch timestamp, others a delay in seconds
+    return max(0, reset - time.time()) if reset > 1e9 else max(0, reset)
+
+def get(url: str, params: Optional[Dict] = None, headers: Optional[Dict] = None) -> httpx.Response:
+    '''
+    GET with exponential backoff (1s, 2s, 4s plus a little jitter) on 429 and 5xx, honouring the delay a rate-limited server asks for up to MAX_RETRY_WAIT.
+    background work from submit() never backs off, so speculative prefetches can't hold up the CLI or its exit
+    '''
+    client = get_client()
+    max_retries = 0 if getattr(_background, "active", False) else MAX_RETRIES
+    for attempt in range(max_retries + 1):
+        response = client.get(url, params=params, headers=headers)
+        if response.status_code not in RETRY_STATUSES or attempt == max_retries: break
+
+        delay = _retry_after(response) if response.status_code in RATE_LIMIT_STATUSES else None
+        if delay is None:
+            backoff = BACKOFF_FACTOR * (2 ** attempt)
+            delay = backoff + random.uniform(0, backoff / 10)
+        if not delay <= MAX_RETRY_WAIT: break # also catches inf/nan
+        time.sleep(delay)
+
+    response.raise_for_status()
+    return response
+
+def submit(fn: Callable[..., Any], *args, **kwargs) -> Future:
+    '''
+    run a blocking call on the shared worker pool so independent requests can overlap
+    '''
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="myanimeplugin")
+    return _executor.submit(_run_in_background, fn, *args, **kwargs)
+
+def _run_in_background(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    _background.active = True
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        _background.active = False
+
+def get_disk_cache() -> Optional[diskcache.Cache]:
+    '''
+    persistent cache shared between runs, or None when diskcache is not installed or the directory is unusable
+    '''
+    global _disk_cache, _disk_cache_failed
+    if _disk_cache is None and diskcache is not None and not _disk_cache_failed:
+        with _disk_cache_lock:
+            if _disk_cache is None and not _disk_cache_failed:
+                try:
+                    _disk_cache = diskcache.Cache(DISK_CACHE_DIR)
+                except (OSError, sqlite3.Error):
+                    _disk_cache_failed = True
+    return _disk_cache
+
+def cache_key(url: str, params: Optional[Dict] = None, namespace: str = "json") -> Tuple[str, str, Tuple[Tuple[str, Hashable], ...]]:
+    return (namespace, url, tuple(sorted((params or {}).items())))
+
+def _disk_get(disk: diskcache.Cache, key: Hashable) -> Any:
+    try:
+        return disk.get((DISK_CACHE_FORMAT, key))
+    except Exception: # locked/read-only database, unreadable pickle... treat as a miss
+        return None
+
+def _disk_set(disk: diskcache.Cache, key: Hashable, value: Any, expire: int) -> None:
+    try:
+        disk.set((DISK_CACHE_FORMAT, key), value, expire=expire)
+    except Exception: # disk full, read-only database, unpicklable value... just skip the write
+        pass
+
+def cached(
+    url: str,
+    params: Optional[Dict],
+    fetch: Callable[[], Any],
+    persist: Optional[int] = None,
+    namespace: str = "json",
+    store: Optional[Callable[[Any], bool]] = None
+) -> Any:
+    '''
+    return the parsed response for (url, params) from the in-memory TTL cache, calling fetch on a miss.
+    concurrent callers for the same key wait on the in-flight fetch instead of issuing their own.
+    with persist set, the on-disk cache is consulted before fetching and keeps the result for that many seconds.
+    namespace tells apart different shapes of value stored for the same url (raw json, html, reduced maps).
+    store decides whether a value is usable; values it rejects (empty lists, challenge pages...) are returned but never cached,
+    and a rejected value read back from disk counts as a miss
+    '''
+    key = cache_key(url, params, namespace)
+    while True:
+        with _CACHE_LOCK:
+            value = _CACHE.get(key, _MISSING) # one lookup, an entry can expire between `in` and `[]`
+            if value is not _MISSING: return value
+            event = _INFLIGHT.get(key)
+            if event is None:
+                event = _INFLIGHT[key] = threading.Event()
+                break
+        event.wait() # if that fetch failed we loop round and try ourselves
+
+    try:
+        disk = get_disk_cache() if persist else None
+        value = _disk_get(disk, key) if disk is not None else None
+        if value is not None and store is not None and not store(value): value = None
+        if value is None:
+            value = fetch()
+            if store is not None and not store(value): return value
+            if disk is not None: _disk_set(disk, key, value, persist)
+        with _CACHE_LOCK:
+            _CACHE[key] = value
+        return value
+    finally:
+        with _CACHE_LOCK:
+            del _INFLIGHT[key]
+        event.set()